@@ -1,12 +1,37 @@
-from fastapi import FastAPI, BackgroundTasks, Query, HTTPException
-from fastapi.responses import PlainTextResponse, Response
+from fastapi import FastAPI, BackgroundTasks, Query, HTTPException, Request
+from fastapi.responses import Response
+from fastapi.concurrency import run_in_threadpool
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import configparser
+import copy
+import io
+import gzip
 import os
 import re
+import string
 import yaml
+from cachetools import TTLCache, LRUCache
 import datetime
+import time
+import threading
 from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# 可选: pybase64 (SIMD 加速) 存在时用于订阅解码, 否则使用标准库
+try:
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
+
+# 优先使用 libyaml 的 C 实现解析/输出 YAML, 缺少 libyaml 时回退到纯 Python 实现
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
 app = FastAPI()
 
@@ -15,67 +40,91 @@ import sys
 sys.stdout.reconfigure(line_buffering=True)
 
 # Cache Storage
-SOURCE_CACHE = {} # {url: {'content': str, 'expires_at': datetime_obj}}
 CACHE_TTL = 180   # 3 minutes
+SOURCE_CACHE = TTLCache(maxsize=256, ttl=CACHE_TTL) # {url: content}, 基于 time.monotonic 过期, 容量有上限
+SOURCE_VALIDATORS = LRUCache(maxsize=256) # {(url, user_agent): (content, etag, last_modified)}, TTL 过期后用于条件请求
+CACHE_LOCK = threading.Lock() # cachetools 非线程安全, 并发抓取时需加锁
+SOURCE_GENERATION = 0 # 订阅内容版本号: 抓到与上次不同的内容时递增, 用于判断输出缓存是否失效
+FETCH_WORKERS = 16 # 并发抓取订阅的线程数
+
+# 链式代理的入口地区: 节点名中含这些标记 (可能在前缀之后, 不一定位于开头) 时生成 "xxx Chain"
+CHAIN_REGIONS = ('JP ', 'KR ', 'TW ')
+CHAIN_REGION_RE = re.compile('|'.join(map(re.escape, CHAIN_REGIONS)))
+
+# 复用连接池, 同一主机的多次请求免去重复的 TCP/TLS 握手
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=2))
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
 
 
 # ==========================================
 # Helper Functions
 # ==========================================
 
+def build_keyword_index(mappings):
+    """
+    将地区关键字表编译为一个预编译正则
+    返回 (keyword_re, kw2code, code_rank): 命中文本经 kw2code 反查地区代码, code_rank 为 mappings 中的优先级
+    """
+    # ASCII 关键字需单词边界, 非 ASCII (中文) 关键字按子串匹配
+    kw2code = {}
+    code_rank = {code: rank for rank, code in enumerate(mappings)}
+    alternatives = []
+    for code, keywords in mappings.items():
+        for kw in keywords:
+            kw2code.setdefault(kw.lower(), code)
+            alternatives.append((kw, r'\b' + re.escape(kw) + r'\b' if kw.isascii() else re.escape(kw)))
+    # 长关键字优先, 避免被其前缀抢先匹配
+    alternatives.sort(key=lambda x: len(x[0]), reverse=True)
+    keyword_re = re.compile('|'.join(pat for _, pat in alternatives), re.IGNORECASE)
+    return keyword_re, kw2code, code_rank
+
 class LocationRenamer:
+    """
+    节点重命名: 识别地区后按 "前缀 + 地区" 分组编号, 如 "[FP] 香港 IPLC" -> "[FP] HK 01"
+    约定: 关键字表与编译后的正则均为类属性, 模块加载时构建一次, 所有实例共享;
+    实例上只有编号计数器这一份可变状态, 因此每次生成配置 new 一个实例即可 (构造开销仅为一个空字典)
+    新增的静态资源请放在类属性上, 不要放进 __init__
+    """
+    # 键: 标准地区代码, 值: 匹配关键字列表
+    mappings = {
+        "HK": ["Hong Kong", "HK", "HongKong", "香港"],
+        "TW": ["Taiwan", "TW", "Taipei", "台湾"],
+        "JP": ["Japan", "JP", "Tokyo", "Osaka", "日本"],
+        "SG": ["Singapore", "SG", "新加坡"],
+        "US": ["United States", "US", "America", "USA", "美国"],
+        "KR": ["Korea", "KR", "Seoul", "韩国"],
+        "UK": ["United Kingdom", "UK", "London", "英国"],
+        "DE": ["Germany", "DE", "Berlin", "德国"],
+        "FR": ["France", "FR", "Paris", "法国"],
+        "CA": ["Canada", "CA", "Montreal", "Toronto", "加拿大"],
+        "AU": ["Australia", "AU", "Sydney", "Melbourne", "澳大利亚"],
+        "NL": ["Netherlands", "NL", "Amsterdam", "荷兰"],
+        "IN": ["India", "IN", "Mumbai", "New Delhi", "印度"],
+        "RU": ["Russia", "RU", "Moscow", "俄罗斯"],
+        "TR": ["Turkey", "TR", "Istanbul", "土耳其"]
+    }
+    _keyword_re, _kw2code, _code_rank = build_keyword_index(mappings)
+
     def __init__(self):
-        # 键: 标准地区代码, 值: 匹配关键字列表
-        self.mappings = {
-            "HK": ["Hong Kong", "HK", "HongKong", "香港"],
-            "TW": ["Taiwan", "TW", "Taipei", "台湾"],
-            "JP": ["Japan", "JP", "Tokyo", "Osaka", "日本"],
-            "SG": ["Singapore", "SG", "新加坡"],
-            "US": ["United States", "US", "America", "USA", "美国"],
-            "KR": ["Korea", "KR", "Seoul", "韩国"],
-            "UK": ["United Kingdom", "UK", "London", "英国"],
-            "DE": ["Germany", "DE", "Berlin", "德国"],
-            "FR": ["France", "FR", "Paris", "法国"],
-            "CA": ["Canada", "CA", "Montreal", "Toronto", "加拿大"],
-            "AU": ["Australia", "AU", "Sydney", "Melbourne", "澳大利亚"],
-            "NL": ["Netherlands", "NL", "Amsterdam", "荷兰"],
-            "IN": ["India", "IN", "Mumbai", "New Delhi", "印度"],
-            "RU": ["Russia", "RU", "Moscow", "俄罗斯"],
-            "TR": ["Turkey", "TR", "Istanbul", "土耳其"]
-        }
-        self.counters = defaultdict(int)
-        self.fallback_counters = defaultdict(int)
+        self.counters = defaultdict(int) # {"前缀_地区": 已分配编号}, 每次生成配置从 01 重新编号
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _classify(name_without_prefix):
+        """识别地区代码 (纯函数, 结果在进程内跨请求缓存), 未命中返回 None"""
+        # 单次扫描取出所有命中的地区, 按 mappings 顺序取优先级最高者
+        cls = LocationRenamer
+        codes = {cls._kw2code.get(m.group(0).lower()) for m in cls._keyword_re.finditer(name_without_prefix)}
+        codes.discard(None)
+        return min(codes, key=cls._code_rank.__getitem__) if codes else None
 
     def get_name(self, original_name):
         # 提取前缀（如 [FP], [NFcloud]）
-        prefix = ""
-        name_without_prefix = original_name
-        if original_name.startswith('[') and ']' in original_name:
-            prefix_end = original_name.index(']')
-            prefix = original_name[:prefix_end + 1]  # 包含 ]
-            name_without_prefix = original_name[prefix_end + 1:].strip()
+        prefix, name_without_prefix = split_prefix(original_name)
         
-        name_lower = name_without_prefix.lower()
-        matched_code = None
-        found_match = False
-        
-        for code, keywords in self.mappings.items():
-            for kw in keywords:
-                # ASCII: word boundary check
-                is_ascii = all(ord(c) < 128 for c in kw)
-                if is_ascii:
-                    pattern = r'(?i)\b' + re.escape(kw) + r'\b'
-                    if re.search(pattern, name_without_prefix):
-                        matched_code = code
-                        found_match = True
-                        break
-                else:
-                    # Non-ASCII: simple substring
-                    if kw in name_without_prefix:
-                        matched_code = code
-                        found_match = True
-                        break
-            if found_match: break
+        matched_code = self._classify(name_without_prefix)
         
         if matched_code:
             # 按 prefix + location 分组编号
@@ -99,74 +148,212 @@ class LocationRenamer:
 def get_file_path(target, filename):
     return os.path.join(os.getcwd(), target, filename)
 
+# 配置/模板文件按 (路径, mtime) 缓存解析结果, 文件未修改时不再重复读取
+# 返回的对象在请求间共享, 调用方只读不写
+@lru_cache(maxsize=32)
+def _read_ini(path, mtime_ns, case_sensitive):
+    c = configparser.ConfigParser(interpolation=None)
+    if case_sensitive: c.optionxform = str
+    c.read(path, encoding='utf-8')
+    return c
+
+@lru_cache(maxsize=32)
+def _read_text(path, mtime_ns):
+    with open(path, 'r', encoding='utf-8') as f: return f.read()
+
+def read_ini_cached(path, case_sensitive=False):
+    return _read_ini(path, os.stat(path).st_mtime_ns, case_sensitive)
+
+def read_text_cached(path):
+    return _read_text(path, os.stat(path).st_mtime_ns)
+
+def split_prefix(name):
+    """拆分节点名前缀: "[FP] HK 01" -> ("[FP]", "HK 01"), 无前缀时返回 ("", name)"""
+    if name[:1] == '[':
+        head, sep, tail = name.partition(']')
+        if sep: return head + sep, tail.strip()
+    return "", name
+
 def get_beijing_time():
     utc_now = datetime.datetime.utcnow()
     beijing_time = utc_now + datetime.timedelta(hours=8)
     return beijing_time.strftime("%Y-%m-%d %H:%M:%S")
 
+def compile_keywords(keywords):
+    """将关键字列表编译为一个多模式正则 (子串匹配), 列表为空时返回 None"""
+    keywords = [k for k in keywords if k]
+    if not keywords: return None
+    return re.compile('|'.join(map(re.escape, keywords)))
+
+def extract_proxy_lines(text_content):
+    """
+    单次扫描提取 Surge 格式的代理行 (Name = type, server, port, ...)
+    存在 [Proxy] 段时只取该段内的行, 否则取全文所有候选行
+    """
+    proxy_lines = []
+    loose_lines = []
+    in_proxy_section = False
+    has_proxy_section = False
+    # 逐行迭代而非 split 出整张行列表, 降低大订阅的峰值内存
+    for line in io.StringIO(text_content):
+        line = line.strip()
+        if not line: continue
+        if line[0] == '[':
+            in_proxy_section = line.lower() == "[proxy]"
+            has_proxy_section = has_proxy_section or in_proxy_section
+            continue
+        if "=" not in line or line.startswith(("#", "//", ";")): continue
+        if in_proxy_section: proxy_lines.append(line)
+        elif not has_proxy_section: loose_lines.append(line)
+    return proxy_lines if has_proxy_section else loose_lines
+
+@lru_cache(maxsize=128)
+def compile_group_predicate(filters, excludes):
+    """
+    将策略组的 filter/exclude 合并为单个正则, 节点名 search 命中即保留
+    exclude 优先, filter 为 OR 逻辑; filter 全为空串时没有节点可保留, 返回 None
+    """
+    filter_pat = '|'.join(re.escape(k) for k in filters if k)
+    exclude_pat = '|'.join(re.escape(k) for k in excludes if k)
+    if filters and not filter_pat: return None
+    pattern = ""
+    if exclude_pat: pattern += f"^(?!.*(?:{exclude_pat}))"
+    if filter_pat: pattern += f"(?=.*(?:{filter_pat}))" if exclude_pat else filter_pat
+    return re.compile(pattern, re.DOTALL)
+
+# 策略组动态节点语法: {all filter=keyword1,keyword2 exclude=keyword3}
+_ALL_RE = re.compile(r"\{all\s*(.*?)\}")
+_PART_RE = re.compile(r"(?:^|\s)(filter|exclude)=(\S*)")
+
 def filter_node_list(rule_str, node_names):
     # Syntax: {all filter=keyword1,keyword2 exclude=keyword3}
-    match = re.search(r"\{all\s*(.*?)\}", rule_str)
+    match = _ALL_RE.search(rule_str)
     if not match: return node_names
     
-    content = match.group(1)
-    filters = []
-    excludes = []
-    
-    parts = content.split()
-    for p in parts:
-        if p.startswith("filter="):
-            filters = p.replace("filter=", "").split(",")
-        if p.startswith("exclude="):
-            excludes = p.replace("exclude=", "").split(",")
-            
-    res = []
-    for node in node_names:
-        # Exclude logic
-        if any(ex in node for ex in excludes if ex): continue
-        
-        # Filter logic (OR logic: match any filter)
-        if filters:
-            if not any(f in node for f in filters if f): continue
+    options = {k: v.split(",") for k, v in _PART_RE.findall(match.group(1))}
+    filters = options.get("filter", [])
+    excludes = options.get("exclude", [])
             
-        res.append(node)
-    return res
+    predicate = compile_group_predicate(tuple(filters), tuple(excludes))
+    if predicate is None: return []
+    return list(filter(predicate.search, node_names))
+
+def resolve_groups(raw_groups, target):
+    """
+    合并 [Groups] 中的通用组与目标专用组 (例如 Auto_surge 覆盖 Auto), 返回 {组名: 规则}
+    带其他目标后缀的组被忽略; 覆盖组沿用基础组的位置, 没有基础组时追加在末尾
+    """
+    target_suffix = f"_{target}".lower()
+    other_suffix = "_clash" if target_suffix == "_surge" else "_surge"
+    final_groups = {}
+    overrides = []
+    # 一次遍历: 每个键只 lower() 一次, 并用元组 endswith 做单次判断
+    for k, v in raw_groups.items():
+        k_lower = k.lower()
+        if k_lower.endswith((target_suffix, other_suffix)):
+            if k_lower.endswith(target_suffix):
+                overrides.append((k[:-len(target_suffix)], v)) # Auto_surge -> Auto
+            continue
+        final_groups[k] = v
+    final_groups.update(overrides)
+    return final_groups
+
+# Clash 配置的顶层 proxies 键必然位于行首, 出现在注释或节点名中的 "proxies:" 不算
+_CLASH_KEY_RE = re.compile(r"^(?:proxies|Proxy):", re.MULTILINE)
+
+def looks_like_clash(text_content):
+    """廉价判断内容是否可能为 Clash YAML, 命中后才交给 YAML 解析器"""
+    return _CLASH_KEY_RE.search(text_content) is not None
+
+# 删除 Base64 字符集后若仍有剩余字符, 说明不是 Base64
+_B64_STRIP_TABLE = str.maketrans('', '', string.ascii_letters + string.digits + '+/=\n\r')
+
+def decode_base64_content(text_content):
+    """订阅内容若为 Base64 编码则返回解码后的文本, 否则原样返回"""
+    # 快速排除: 开头出现 Base64 以外的字符, 或含空格/非 ASCII 字符 (如中文节点名) 的内容不可能是 Base64
+    if len(text_content) <= 10 or text_content[:64].translate(_B64_STRIP_TABLE):
+        return text_content
+    if " " in text_content or not text_content.isascii():
+        return text_content
+    missing = len(text_content) % 4
+    try:
+        decoded = b64decode(text_content + '=' * (4 - missing) if missing else text_content).decode('utf-8')
+    except ValueError: # binascii.Error / UnicodeDecodeError
+        return text_content
+    return decoded if "\n" in decoded or "\r" in decoded else text_content
 
 def fetch_content_cached(url, headers=None, timeout=15):
     """
     带缓存的 URL 获取
     Key = URL (忽略 UA 差异以最大化共享，除非差异导致了解析失败，目前假设解析器足够健壮)
     """
-    global SOURCE_CACHE
-    now = datetime.datetime.now()
-    
-    # 1. Check Cache
-    if url in SOURCE_CACHE:
-        entry = SOURCE_CACHE[url]
-        if entry['expires_at'] > now:
-            print(f"[Cache] Hit for {url}")
-            return entry['content'], 200
-        else:
-            print(f"[Cache] Expired for {url}")
-            del SOURCE_CACHE[url]
+    # 1. Check Cache (过期条目由 TTLCache 自动淘汰)
+    # 条件请求的校验值按 (URL, User-Agent) 区分: 订阅商按 UA 返回不同格式, 混用会让 304 复用到另一种格式的内容
+    validator_key = (url, (headers or {}).get("User-Agent"))
+    with CACHE_LOCK:
+        content = SOURCE_CACHE.get(url)
+        validator = SOURCE_VALIDATORS.get(validator_key)
+    if content is not None:
+        print(f"[Cache] Hit for {url}")
+        return content, 200
     
-    # 2. Fetch
+    # 2. Fetch (已有 ETag/Last-Modified 时发送条件请求, 304 则复用旧内容)
+    req_headers = dict(headers or {})
+    if validator:
+        _, etag, last_modified = validator
+        if etag: req_headers['If-None-Match'] = etag
+        if last_modified: req_headers['If-Modified-Since'] = last_modified
     try:
         print(f"[Network] Fetching {url}")
-        resp = requests.get(url, headers=headers, timeout=timeout)
+        resp = SESSION.get(url, headers=req_headers, timeout=timeout)
+        if resp.status_code == 304 and validator:
+            print(f"[Cache] Not modified: {url}")
+            with CACHE_LOCK:
+                SOURCE_CACHE[url] = validator[0]
+            return validator[0], 200
         if resp.status_code == 200:
             # Update Cache
-            expires = now + datetime.timedelta(seconds=CACHE_TTL)
-            SOURCE_CACHE[url] = {
-                'content': resp.text,
-                'expires_at': expires
-            }
+            global SOURCE_GENERATION
+            with CACHE_LOCK:
+                # 与同一 UA 上次的内容比较; 按 URL 比较时两个 target 交替抓取会互相覆盖, 版本号每次都变
+                previous = SOURCE_VALIDATORS.get(validator_key)
+                if previous is None or previous[0] != resp.text: SOURCE_GENERATION += 1
+                SOURCE_CACHE[url] = resp.text
+                SOURCE_VALIDATORS[validator_key] = (resp.text, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
             return resp.text, 200
         return None, resp.status_code
     except Exception as e:
         print(f"[Network] Error fetching {url}: {e}")
         return None, 500
 
+def fetch_sources(sources, headers=None):
+    """
+    并发抓取 [Sources] 中的全部订阅
+    返回 [(src_name, prefix, text_content, status_code), ...], 顺序与配置一致
+    """
+    entries = []
+    for src_name, raw_val in sources.items():
+        url, prefix = (raw_val.split('|', 1) + [""])[:2]
+        entries.append((src_name, url.strip(), prefix.strip()))
+    if not entries: return []
+
+    # 网络等待可重叠, 总耗时约为最慢的一个源; 解析仍由调用方串行完成以保证命名稳定
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(entries))) as ex:
+        results = list(ex.map(lambda e: fetch_content_cached(e[1], headers=headers), entries))
+    return [(src_name, prefix, text_content, status_code)
+            for (src_name, _, prefix), (text_content, status_code) in zip(entries, results)]
+
+def fetch_target_sources(target, conf):
+    """以 target 对应的 User-Agent 抓取 conf 中的 [Sources]"""
+    if 'Sources' not in conf: return []
+    settings = conf['Settings'] if 'Settings' in conf else {}
+    # 优先读取 user_agent_<target>，否则读取 user_agent，最后默认
+    if target == "clash":
+        custom_ua = settings.get('user_agent_clash', settings.get('user_agent', 'Clash/1.0'))
+    else:
+        custom_ua = settings.get('user_agent_surge', settings.get('user_agent', 'Surge/5'))
+    return fetch_sources(conf['Sources'], headers={"User-Agent": custom_ua})
+
 # ==========================================
 # 4. Gist 同步逻辑
 # ==========================================
@@ -180,8 +367,7 @@ def get_merged_config(filename, target):
     unified_path = get_file_path('config', filename)
     if os.path.exists(unified_path):
         try:
-            parser = configparser.ConfigParser(interpolation=None)
-            parser.read(unified_path, encoding='utf-8')
+            parser = read_ini_cached(unified_path)
             
             # 基础配置
             conf = {}
@@ -237,7 +423,7 @@ def upload_to_gist(target: str, content_body: str):
         payload = {"files": { filename: { "content": final_content } }}
         
         print(f"[{target}] Uploading {filename} to Gist...")
-        r = requests.patch(f"https://api.github.com/gists/{gist_id}", headers=headers, json=payload, timeout=20)
+        r = SESSION.patch(f"https://api.github.com/gists/{gist_id}", headers=headers, json=payload, timeout=20)
         
         if r.status_code == 200:
             print(f"[{target}] ✅ Gist Upload Success! (Time: {timestamp})")
@@ -256,14 +442,44 @@ def load_main_config(target):
     # 1. 尝试统一配置
     unified_path = get_file_path('config', 'config.ini')
     if os.path.exists(unified_path):
-        c = configparser.ConfigParser(interpolation=None)
-        c.optionxform = str
-        c.read(unified_path, encoding='utf-8')
-        return c
+        return read_ini_cached(unified_path, case_sensitive=True)
     
     return None
 
-def process_surge_config(target):
+# Clash proxy -> Surge 代理行, 按协议类型分派; get 为 proxy.get
+def _surge_line_ss(name, server, port, get):
+    return f"{name} = ss, {server}, {port}, encrypt-method={get('cipher', '')}, password={get('password', '')}"
+
+def _surge_line_vmess(name, server, port, get):
+    tls = "true" if get('tls') else "false"
+    return f"{name} = vmess, {server}, {port}, username={get('uuid', '')}, tls={tls}"
+
+def _surge_line_trojan(name, server, port, get):
+    skip_cert = "true" if get('skip-cert-verify') else "false"
+    line = f"{name} = trojan, {server}, {port}, password={get('password', '')}, skip-cert-verify={skip_cert}"
+    sni = get('sni', '')
+    return f"{line}, sni={sni}" if sni else line
+
+def _surge_line_http(name, server, port, get):
+    return f"{name} = http, {server}, {port}, username={get('username', '')}, password={get('password', '')}"
+
+def _surge_line_socks5(name, server, port, get):
+    return f"{name} = socks5, {server}, {port}, username={get('username', '')}, password={get('password', '')}"
+
+def _surge_line_snell(name, server, port, get):
+    return f"{name} = snell, {server}, {port}, psk={get('psk', '')}, version={get('version', '2')}"
+
+SURGE_LINE_BUILDERS = {
+    'ss': _surge_line_ss,
+    'vmess': _surge_line_vmess,
+    'trojan': _surge_line_trojan,
+    'http': _surge_line_http,
+    'socks5': _surge_line_socks5,
+    'snell': _surge_line_snell,
+}
+
+def process_surge_config(target, fetched=None):
+    """fetched: 预先抓取的 fetch_target_sources 结果, 省略时自行抓取"""
     # 读取基础配置
     conf = load_main_config(target)
     if not conf: return f"Error: config.ini not found"
@@ -272,137 +488,87 @@ def process_surge_config(target):
     tpl_path = get_file_path('config', 'surge_template.ini')
     
     if not os.path.exists(tpl_path): return f"Error: template.ini not found"
-    with open(tpl_path, 'r', encoding='utf-8') as f: template_body = f.read()
+    template_body = read_text_cached(tpl_path)
 
     # 初始化重命名器
     renamer = LocationRenamer()
 
     # 参数
     settings = conf['Settings'] if 'Settings' in conf else {}
-    # 优先读取 user_agent_surge，否则读取 user_agent，最后默认
-    custom_ua = settings.get('user_agent_surge', settings.get('user_agent', 'Surge/5'))
     exclude_keys = [k.strip() for k in settings.get('exclude_keywords', '').split(',') if k.strip()]
-    headers = {"User-Agent": custom_ua}
+    exclude_re = compile_keywords(exclude_keys)
     
     all_proxies = {}
-    seen_fingerprints = set()
+    seen_fingerprints = set() # {(type, server, port)}
 
     # 抓取订阅
-    if 'Sources' in conf:
-        for src_name in conf['Sources']:
-            raw_val = conf['Sources'][src_name]
-            url, prefix = (raw_val.split('|', 1) + [""])[:2]
-            url = url.strip(); prefix = prefix.strip()
-            
+    if fetched is None: fetched = fetch_target_sources(target, conf)
+    if fetched:
+        for src_name, prefix, text_content, status_code in fetched:
             try:
-                text_content, status_code = fetch_content_cached(url, headers=headers)
                 if status_code == 200 and text_content:
-                    # if " " not in text_content and len(text_content) > 10: (Removed redundant check, decode handles it)
-                    if " " not in text_content and len(text_content) > 10:
-                        try:
-                            import base64
-                            missing = len(text_content) % 4
-                            if missing: text_content += '=' * (4 - missing)
-                            decoded = base64.b64decode(text_content).decode('utf-8')
-                            if "\n" in decoded or "\r" in decoded: text_content = decoded
-                        except: pass
+                    text_content = decode_base64_content(text_content)
 
                     # Clash 解析 attempt
                     is_clash = False
-                    if "proxies:" in text_content or "Proxy:" in text_content:
+                    if looks_like_clash(text_content):
                         try:
-                            clash_data = yaml.safe_load(text_content)
-                            if clash_data and isinstance(clash_data, dict) and 'proxies' in clash_data:
+                            clash_data = yaml.load(text_content, Loader=YamlLoader)
+                            # 解析出映射即视为 Clash 订阅, 即便没有 proxies 列表也不再回退到逐行文本解析
+                            if isinstance(clash_data, dict):
                                 is_clash = True
-                                for proxy in clash_data['proxies']:
-                                    p_name = proxy.get('name', '')
-                                    p_type = proxy.get('type', '').lower()
-                                    p_server = proxy.get('server', '')
-                                    p_port = proxy.get('port', '')
+                                for proxy in clash_data.get('proxies') or ():
+                                    get = proxy.get
+                                    p_name = get('name', '')
+                                    p_type = get('type', '').lower()
+                                    p_server = get('server', '')
+                                    p_port = get('port', '')
                                     if not p_name or not p_server or not p_port: continue
                                     
                                     # 指纹
-                                    fingerprint = f"{p_type}|{p_server}|{p_port}"
+                                    fingerprint = (p_type, p_server, str(p_port))
                                     if fingerprint in seen_fingerprints: continue
                                     seen_fingerprints.add(fingerprint)
                                     
-                                    if any(k in p_name for k in exclude_keys): continue
+                                    if exclude_re and exclude_re.search(p_name): continue
                                     
                                     # 使用 LocationRenamer
                                     p_name = renamer.get_name(p_name)
                                     final_name = f"{prefix} {p_name}".strip() if prefix else p_name
                                     
-                                    surge_line = ""
-                                    if p_type == 'ss':
-                                        cipher = proxy.get('cipher', '')
-                                        password = proxy.get('password', '')
-                                        surge_line = f"{final_name} = ss, {p_server}, {p_port}, encrypt-method={cipher}, password={password}"
-                                    elif p_type == 'vmess':
-                                        uuid = proxy.get('uuid', '')
-                                        tls = "true" if proxy.get('tls') else "false"
-                                        surge_line = f"{final_name} = vmess, {p_server}, {p_port}, username={uuid}, tls={tls}"
-                                    elif p_type == 'trojan':
-                                        password = proxy.get('password', '')
-                                        sni = proxy.get('sni', '')
-                                        skip_cert = "true" if proxy.get('skip-cert-verify') else "false"
-                                        surge_line = f"{final_name} = trojan, {p_server}, {p_port}, password={password}, skip-cert-verify={skip_cert}"
-                                        if sni: surge_line += f", sni={sni}"
-                                    elif p_type == 'http':
-                                        username = proxy.get('username', '')
-                                        password = proxy.get('password', '')
-                                        surge_line = f"{final_name} = http, {p_server}, {p_port}, username={username}, password={password}"
-                                    elif p_type == 'socks5':
-                                        username = proxy.get('username', '')
-                                        password = proxy.get('password', '')
-                                        surge_line = f"{final_name} = socks5, {p_server}, {p_port}, username={username}, password={password}"
-                                    elif p_type == 'snell':
-                                        psk = proxy.get('psk', '')
-                                        version = proxy.get('version', '2')
-                                        surge_line = f"{final_name} = snell, {p_server}, {p_port}, psk={psk}, version={version}"
-                                    
-                                    if surge_line:
-                                        all_proxies[final_name] = surge_line
+                                    build_line = SURGE_LINE_BUILDERS.get(p_type)
+                                    if build_line:
+                                        all_proxies[final_name] = build_line(final_name, p_server, p_port, get)
                         except: pass
 
                     # 文本解析 attempt
                     if not is_clash:
-                        lines = text_content.split('\n')
-                        in_proxy_section = False
-                        has_proxy_section = any(l.strip().lower() == "[proxy]" for l in lines)
-                        
-                        for line in lines:
-                            line = line.strip()
-                            if not line: continue
-                            if line.lower() == "[proxy]": in_proxy_section = True; continue
-                            if line.startswith("[") and line.lower() != "[proxy]": in_proxy_section = False; continue
-                            if has_proxy_section and not in_proxy_section: continue
-
-                            if "=" in line and not line.startswith(("#", "//", ";")):
-                                try:
-                                    parts = line.split("=", 1)
-                                    name = parts[0].strip()
-                                    detail = parts[1].strip()
-                                    
-                                    d_parts = [x.strip() for x in detail.split(',')]
-                                    if len(d_parts) < 3: continue
-                                    
-                                    p_type = d_parts[0].lower()
-                                    p_server = d_parts[1]
-                                    p_port = d_parts[2]
-                                    
-                                    # 指纹
-                                    fingerprint = f"{p_type}|{p_server}|{p_port}"
-                                    if fingerprint in seen_fingerprints: continue
-                                    seen_fingerprints.add(fingerprint)
+                        for line in extract_proxy_lines(text_content):
+                            try:
+                                parts = line.split("=", 1)
+                                name = parts[0].strip()
+                                detail = parts[1].strip()
+                                
+                                d_parts = [x.strip() for x in detail.split(',')]
+                                if len(d_parts) < 3: continue
+                                
+                                p_type = d_parts[0].lower()
+                                p_server = d_parts[1]
+                                p_port = d_parts[2]
+                                
+                                # 指纹
+                                fingerprint = (p_type, p_server, str(p_port))
+                                if fingerprint in seen_fingerprints: continue
+                                seen_fingerprints.add(fingerprint)
 
-                                    if any(k in name for k in exclude_keys): continue
-                                    
-                                    # 使用 LocationRenamer
-                                    name = renamer.get_name(name)
-                                    final_name = f"{prefix} {name}".strip() if prefix else name
-                                    
-                                    all_proxies[final_name] = f"{final_name} = {detail}"
-                                except: pass
+                                if exclude_re and exclude_re.search(name): continue
+                                
+                                # 使用 LocationRenamer
+                                name = renamer.get_name(name)
+                                final_name = f"{prefix} {name}".strip() if prefix else name
+                                
+                                all_proxies[final_name] = f"{final_name} = {detail}"
+                            except: pass
             except Exception as e: print(f"[{target}] Error fetching {src_name}: {e}")
 
     # Manual (Surge) - 不进行重命名处理
@@ -436,7 +602,7 @@ def process_surge_config(target):
                 if node_name == 'EXIT':
                     continue
                 # 只为 JP/KR/TW 节点创建链式代理
-                if any(region in node_name for region in ['JP ', 'KR ', 'TW ']):
+                if CHAIN_REGION_RE.search(node_name):
                     # 创建链式代理版本: 命名为 "完整节点名 Chain"
                     chain_name = f"{node_name} Chain"
                     chain_line = f"{chain_name} = {us_ip_detail}, underlying-proxy={node_name}"
@@ -447,59 +613,29 @@ def process_surge_config(target):
 
 
     # 组装 - 按前缀分组并排序
-    # 1. 按前缀分组
-    from collections import defaultdict
+    # 1. 全部节点按名称排序一次 (策略组展开也复用该顺序)
+    sorted_node_names = sorted(all_proxies)
+
+    # 2. 按前缀分组: 输入已有序, 稳定分桶后组内自然有序, 无需再排序
     prefix_groups = defaultdict(list)
-    
-    for node_name, node_line in all_proxies.items():
-        # 提取前缀
-        prefix = ""
-        if node_name.startswith('[') and ']' in node_name:
-            prefix_end = node_name.index(']')
-            prefix = node_name[:prefix_end + 1]  # 包含 ]
-        prefix_groups[prefix].append((node_name, node_line))
-    
-    # 2. 对每个组内的节点按名称排序
-    for prefix in prefix_groups:
-        prefix_groups[prefix].sort(key=lambda x: x[0])
+    for node_name in sorted_node_names:
+        prefix, _ = split_prefix(node_name)
+        prefix_groups[prefix].append(node_name)
     
     # 3. 按前缀排序（无前缀的放最后）
     sorted_prefixes = sorted(prefix_groups.keys(), key=lambda x: (x == "", x))
     
     # 4. 组装 proxy_section
-    proxy_lines = ["[Proxy]"]
+    proxy_section = ["[Proxy]"]
     for prefix in sorted_prefixes:
-        for node_name, node_line in prefix_groups[prefix]:
-            proxy_lines.append(node_line)
+        proxy_section.extend(all_proxies[node_name] for node_name in prefix_groups[prefix])
     
-    proxy_section = proxy_lines
     group_section = ["[Proxy Group]"]
-    sorted_node_names = sorted(all_proxies.keys())
     
     if 'Groups' in conf:
         # 处理策略组覆盖逻辑 (例如 Auto_surge 覆盖 Auto)
-        raw_groups = conf['Groups']
-        final_groups = {}
-        target_suffix = f"_{target}".lower()
-        
-        # 1. 加载基础组 (跳过带 explicitly 其他 target 后缀的)
-        other_target = "clash" if target == "surge" else "surge"
-        other_suffix = f"_{other_target}"
-        
-        for k, v in raw_groups.items():
-            k_lower = k.lower()
-            if k_lower.endswith(target_suffix): continue # 稍后处理
-            if k_lower.endswith(other_suffix): continue  # 忽略其他目标的专用组
-            final_groups[k] = v
-            
-        # 2. 加载特定覆盖
-        for k, v in raw_groups.items():
-            if k.lower().endswith(target_suffix):
-                real_name = k[:-len(target_suffix)] # Auto_surge -> Auto
-                final_groups[real_name] = v
-
-        for g_name, g_rule in final_groups.items():
-            match = re.search(r"\{all\s*(.*?)\}", g_rule)
+        for g_name, g_rule in resolve_groups(conf['Groups'], target).items():
+            match = _ALL_RE.search(g_rule)
             if match:
                 filtered_list = filter_node_list(g_rule, sorted_node_names)
                 nodes_str = ", ".join(filtered_list) if filtered_list else "DIRECT"
@@ -508,13 +644,138 @@ def process_surge_config(target):
             else:
                 group_section.append(f"{g_name} = {g_rule}")
 
-    return template_body + "\n\n" + "\n".join(proxy_section) + "\n\n" + "\n".join(group_section)
+    # 一次 join 拼出全文, 避免多段大字符串的中间拷贝 (各段之间空一行)
+    return "\n".join([template_body, "", *proxy_section, "", *group_section])
 
 # ==========================================
 # 3. Clash 配置处理逻辑
 # ==========================================
 
-def process_clash_config(target):
+# Clash 内置策略, 可直接出现在策略组中
+CLASH_BUILTIN_POLICIES = frozenset({"DIRECT", "REJECT", "REJECT-DROP", "PASS", "COMPATIBLE", "GLOBAL"})
+
+# Surge kv 参数 -> Clash proxy 字段, 按协议类型分派; 原地填充 proxy_obj
+def _conv_ss(proxy_obj, kv_params):
+    proxy_obj['cipher'] = kv_params.get('encrypt-method', '')
+    proxy_obj['password'] = kv_params.get('password', '')
+
+def _conv_vmess(proxy_obj, kv_params):
+    proxy_obj['uuid'] = kv_params.get('username', '')
+    proxy_obj['cipher'] = 'auto'
+    proxy_obj['tls'] = True if kv_params.get('tls', 'false') == 'true' else False
+
+def _conv_trojan(proxy_obj, kv_params):
+    proxy_obj['password'] = kv_params.get('password', '')
+    if 'sni' in kv_params: proxy_obj['sni'] = kv_params['sni']
+    if kv_params.get('skip-cert-verify') == 'true': proxy_obj['skip-cert-verify'] = True
+
+def _conv_http(proxy_obj, kv_params):
+    # http / socks5 共用
+    proxy_obj['username'] = kv_params.get('username', '')
+    proxy_obj['password'] = kv_params.get('password', '')
+    # 支持 underlying-proxy -> dialer-proxy
+    if 'underlying-proxy' in kv_params:
+        proxy_obj['dialer-proxy'] = kv_params['underlying-proxy']
+
+def _conv_snell(proxy_obj, kv_params):
+    proxy_obj['psk'] = kv_params.get('psk', '')
+    proxy_obj['version'] = kv_params.get('version', '2')
+
+def _conv_hysteria2(proxy_obj, kv_params):
+    proxy_obj['password'] = kv_params.get('password', '')
+    if 'sni' in kv_params:
+        proxy_obj['sni'] = kv_params['sni']
+    # 只在需要跳过证书验证时添加该字段
+    if kv_params.get('skip-cert-verify') == 'true':
+        proxy_obj['skip-cert-verify'] = True
+    if 'alpn' in kv_params:
+        # alpn 可能是逗号分隔的列表
+        alpn_val = kv_params['alpn']
+        if ',' in alpn_val:
+            proxy_obj['alpn'] = [a.strip() for a in alpn_val.split(',')]
+        else:
+            proxy_obj['alpn'] = [alpn_val]
+    if 'obfs' in kv_params:
+        proxy_obj['obfs'] = kv_params['obfs']
+    if 'obfs-password' in kv_params:
+        proxy_obj['obfs-password'] = kv_params['obfs-password']
+    if 'download-bandwidth' in kv_params:
+        try:
+            proxy_obj['down'] = int(kv_params['download-bandwidth'])
+        except ValueError: pass
+    if 'upload-bandwidth' in kv_params:
+        try:
+            proxy_obj['up'] = int(kv_params['upload-bandwidth'])
+        except ValueError: pass
+    # 其他布尔参数
+    if kv_params.get('udp-relay') == 'true':
+        proxy_obj['udp'] = True
+    if kv_params.get('tfo') == 'true':
+        proxy_obj['fast-open'] = True
+
+SURGE_CONVERTERS = {
+    'ss': _conv_ss,
+    'vmess': _conv_vmess,
+    'trojan': _conv_trojan,
+    'http': _conv_http,
+    'socks5': _conv_http,
+    'snell': _conv_snell,
+    'hysteria2': _conv_hysteria2,
+}
+
+def surge_line_to_clash(line):
+    """
+    解析 Surge 格式代理行 "Name = type, server, port, key=value, ..." 为 Clash proxy 对象
+    字段不足时返回 None; 未支持的协议只保留 name/type/server/port
+    """
+    name, _, detail = line.partition("=")
+    
+    # 头部只切出 type/server/port 三段, 其余参数留在 rest 中一次性拆分, 避免对整行逐段 strip 后再切片
+    d_parts = detail.split(',', 3)
+    if len(d_parts) < 3: return None
+    
+    p_type = d_parts[0].strip().lower()
+    proxy_obj = {
+        "name": name.strip(),
+        "type": p_type,
+        "server": d_parts[1].strip(),
+        "port": d_parts[2].strip()
+    }
+    
+    # 填充额外参数 (简化版，仅提取核心参数以支持 Clash 输出)
+    # 注意：从 Surge string 完美还原 Clash object 比较复杂，这里做尽力而为的转换
+    kv_params = {}
+    if len(d_parts) > 3:
+        for k, sep, v in (item.partition("=") for item in d_parts[3].split(',')):
+            if sep: kv_params[k.strip()] = v.strip()
+    
+    convert = SURGE_CONVERTERS.get(p_type)
+    if convert: convert(proxy_obj, kv_params)
+    return proxy_obj
+
+@lru_cache(maxsize=4)
+def load_clash_template(path, mtime_ns):
+    """按 mtime 缓存解析后的 Clash 模板; 返回对象跨请求共享, 调用方需先复制再修改"""
+    # 整块 bytes 交给 C 解析器, 避免经由文本文件对象分段读取
+    return yaml.load(Path(path).read_bytes(), Loader=YamlLoader)
+
+@lru_cache(maxsize=4)
+def load_manual_clash_proxies(path, mtime_ns):
+    """按 mtime 缓存 manual.ini (Surge 格式) 转换出的 Clash proxy 列表; 返回对象跨请求共享, 调用方需先复制再修改"""
+    proxies = []
+    # 文件很小, 一次读入后切行
+    for line in Path(path).read_text(encoding='utf-8').splitlines():
+        line = line.strip()
+        if not line or line.startswith(("#", ";", "//", "[")): continue
+        if "=" in line:
+            try:
+                proxy_obj = surge_line_to_clash(line)
+                if proxy_obj: proxies.append(proxy_obj)
+            except (ValueError, KeyError): pass
+    return tuple(proxies)
+
+def process_clash_config(target, fetched=None):
+    """fetched: 预先抓取的 fetch_target_sources 结果, 省略时自行抓取"""
     conf = load_main_config(target)
     if not conf: return "Error: config.ini not found"
     
@@ -522,21 +783,20 @@ def process_clash_config(target):
     tpl_path = get_file_path('config', 'clash_template.yaml')
     
     if not os.path.exists(tpl_path): return "Error: template.yaml not found"
-    with open(tpl_path, 'r', encoding='utf-8') as f:
-        clash_data = yaml.safe_load(f)
+    # 只替换顶层的 proxies / proxy-groups, 浅拷贝即可
+    clash_data = dict(load_clash_template(tpl_path, os.stat(tpl_path).st_mtime_ns))
 
     # 初始化重命名器
     renamer = LocationRenamer()
             
     settings = conf['Settings'] if 'Settings' in conf else {}
-    # 优先读取 user_agent_clash，否则读取 user_agent，最后默认
-    custom_ua = settings.get('user_agent_clash', settings.get('user_agent', 'Clash/1.0'))
-    
     exclude_keys = [k.strip() for k in settings.get('exclude_keywords', '').split(',') if k.strip()]
+    exclude_re = compile_keywords(exclude_keys)
     
     all_proxies = []
-    seen_fingerprints = set()
-    seen_names = set() # Clash list checking is different, use set for names
+    seen_fingerprints = set() # {(type, server, port)}
+    name_to_proxy = {} # {name: proxy}, 与 all_proxies 同步维护, 兼做重名检查与 O(1) 查找
+    name_collision_counts = {} # {基础名: 已分配的最大重名后缀}
     
     # 辅助：添加代理并去重
     def add_proxy(p_data, p_prefix="", skip_rename=False):
@@ -544,12 +804,13 @@ def process_clash_config(target):
         if not p_name: return
         
         # 排除
-        if any(k in p_name for k in exclude_keys): return
+        if exclude_re and exclude_re.search(p_name): return
         
         # 重命名 (LocationRenamer) - 除非是 manual 节点
         if not skip_rename:
             p_name = renamer.get_name(p_name)
-        if p_prefix: p_name = f"{p_prefix} {p_name}".strip()
+        # 前缀在 fetch_sources 中已 strip, 重命名结果也不含首尾空白, 直接拼接即可
+        if p_prefix: p_name = p_prefix + ' ' + p_name
         
         # 指纹去重
         p_type = p_data.get('type', '')
@@ -557,159 +818,53 @@ def process_clash_config(target):
         p_port = p_data.get('port', '')
         
         if p_type and p_server and p_port:
-            fingerprint = f"{p_type}|{p_server}|{p_port}"
+            fingerprint = (p_type, p_server, str(p_port))
             if fingerprint in seen_fingerprints: return
             seen_fingerprints.add(fingerprint)
         
-        # URL/Map key collision check (Final safeguard, although renamer handles duplicates)
-        # renamer handles duplicates for mapped locations, and fallback numbers,
-        # but if prefix is added, or multiple sources cause collision?
-        # Safe to keep a basic check or trust renamer?
-        # With prefix, it might still collide if prefix is same.
-        # Let's trust renamer ensures uniqueness for base name.
-        # But allow safeguard if p_prefix modifies it?
-        # Let's keep a simple safeguard loop just in case.
+        # 重名兜底: renamer 已为每个前缀+地区编号, 但同前缀的多个源或 manual 节点仍可能撞名, 依次使用 _2, _3, ...
+        # 记录每个基础名已用到的后缀, 下次直接从其后继续, 不必从 _2 逐个试探
         final_name = p_name
-        idx = 1
-        while final_name in seen_names:
-            idx += 1
-            final_name = f"{p_name}_{idx}"
+        if final_name in name_to_proxy:
+            idx = name_collision_counts.get(p_name, 1) + 1
+            final_name = p_name + '_' + str(idx)
+            while final_name in name_to_proxy: # 该后缀恰好已被其他节点占用时才继续递增
+                idx += 1
+                final_name = p_name + '_' + str(idx)
+            name_collision_counts[p_name] = idx
         
-        seen_names.add(final_name)
         p_data['name'] = final_name
+        name_to_proxy[final_name] = p_data
         all_proxies.append(p_data)
 
-    if 'Sources' in conf:
-        for src_name in conf['Sources']:
-            raw_val = conf['Sources'][src_name]
-            url, prefix = (raw_val.split('|', 1) + [""])[:2]
-            url = url.strip(); prefix = prefix.strip()
-            
+    if fetched is None: fetched = fetch_target_sources(target, conf)
+    if fetched:
+        for src_name, prefix, text_content, status_code in fetched:
             try:
-                text_content, status_code = fetch_content_cached(url, headers={"User-Agent": custom_ua})
                 if status_code == 200 and text_content:
                     # Base64 解码尝试
-                    if " " not in text_content and len(text_content) > 10:
-                        try:
-                            import base64
-                            missing_padding = len(text_content) % 4
-                            if missing_padding: text_content += '=' * (4 - missing_padding)
-                            decoded = base64.b64decode(text_content).decode('utf-8')
-                            if "\n" in decoded or "\r" in decoded: text_content = decoded
-                        except: pass
+                    text_content = decode_base64_content(text_content)
 
                     # 尝试 YAML 解析
                     is_yaml_success = False
-                    if "proxies:" in text_content or "Proxy:" in text_content:
+                    if looks_like_clash(text_content):
                         try:
-                            data = yaml.safe_load(text_content)
-                            if data and 'proxies' in data and isinstance(data['proxies'], list):
+                            data = yaml.load(text_content, Loader=YamlLoader)
+                            # 解析出映射即视为 YAML 订阅, 即便没有 proxies 列表也不再回退到逐行文本解析
+                            if isinstance(data, dict):
                                 is_yaml_success = True
-                                for proxy in data['proxies']:
-                                    add_proxy(proxy, prefix)
+                                if isinstance(data.get('proxies'), list):
+                                    for proxy in data['proxies']:
+                                        add_proxy(proxy, prefix)
                         except: pass
                     
                     # 尝试 Surge/文本 解析 (如果 YAML 失败)
                     if not is_yaml_success:
-                        lines = text_content.split('\n')
-                        in_proxy_section = False
-                        has_proxy_section = any(l.strip().lower() == "[proxy]" for l in lines)
-                        
-                        for line in lines:
-                            line = line.strip()
-                            if not line: continue
-                            if line.lower() == "[proxy]": in_proxy_section = True; continue
-                            if line.startswith("[") and line.lower() != "[proxy]": in_proxy_section = False; continue
-                            if has_proxy_section and not in_proxy_section: continue
-                            
-                            if "=" in line and not line.startswith(("#", "//", ";")):
-                                try:
-                                    # 解析 Surge 格式: Name = type, server, port, ...
-                                    parts = line.split("=", 1)
-                                    name = parts[0].strip()
-                                    detail = parts[1].strip()
-                                    
-                                    d_parts = [x.strip() for x in detail.split(',')]
-                                    if len(d_parts) < 3: continue
-                                    
-                                    # 构造 Clash Proxy Object
-                                    p_type = d_parts[0].lower()
-                                    p_server = d_parts[1]
-                                    p_port = d_parts[2]
-                                    
-                                    proxy_obj = {
-                                        "name": name,
-                                        "type": p_type,
-                                        "server": p_server,
-                                        "port": p_port
-                                    }
-                                    
-                                    # 填充额外参数 (简化版，仅提取核心参数以支持 Clash 输出)
-                                    # 注意：从 Surge string 完美还原 Clash object 比较复杂，
-                                    # 这里做尽力而为的转换，主要支持 ss, trojan, vmess, http, socks5
-                                    # 提取 kv 参数
-                                    kv_params = {}
-                                    for item in d_parts[3:]:
-                                        if "=" in item:
-                                            k, v = item.split("=", 1)
-                                            kv_params[k.strip()] = v.strip()
-                                    
-                                    if p_type == 'ss':
-                                        proxy_obj['cipher'] = kv_params.get('encrypt-method', '')
-                                        proxy_obj['password'] = kv_params.get('password', '')
-                                    elif p_type == 'vmess':
-                                        proxy_obj['uuid'] = kv_params.get('username', '')
-                                        proxy_obj['cipher'] = 'auto'
-                                        proxy_obj['tls'] = True if kv_params.get('tls', 'false') == 'true' else False
-                                    elif p_type == 'trojan':
-                                        proxy_obj['password'] = kv_params.get('password', '')
-                                        if 'sni' in kv_params: proxy_obj['sni'] = kv_params['sni']
-                                        if kv_params.get('skip-cert-verify') == 'true': proxy_obj['skip-cert-verify'] = True
-                                    elif p_type in ['http', 'socks5']:
-                                        proxy_obj['username'] = kv_params.get('username', '')
-                                        proxy_obj['password'] = kv_params.get('password', '')
-                                        # 支持 underlying-proxy -> dialer-proxy
-                                        if 'underlying-proxy' in kv_params:
-                                            proxy_obj['dialer-proxy'] = kv_params['underlying-proxy']
-                                    elif p_type == 'snell':
-                                        proxy_obj['psk'] = kv_params.get('psk', '')
-                                        proxy_obj['version'] = kv_params.get('version', '2')
-                                    elif p_type == 'hysteria2':
-                                        # Hysteria2 参数转换
-                                        proxy_obj['password'] = kv_params.get('password', '')
-                                        if 'sni' in kv_params:
-                                            proxy_obj['sni'] = kv_params['sni']
-                                        # 只在需要跳过证书验证时添加该字段
-                                        if kv_params.get('skip-cert-verify') == 'true':
-                                            proxy_obj['skip-cert-verify'] = True
-                                        if 'alpn' in kv_params:
-                                            # alpn 可能是逗号分隔的列表
-                                            alpn_val = kv_params['alpn']
-                                            if ',' in alpn_val:
-                                                proxy_obj['alpn'] = [a.strip() for a in alpn_val.split(',')]
-                                            else:
-                                                proxy_obj['alpn'] = [alpn_val]
-                                        if 'obfs' in kv_params:
-                                            proxy_obj['obfs'] = kv_params['obfs']
-                                        if 'obfs-password' in kv_params:
-                                            proxy_obj['obfs-password'] = kv_params['obfs-password']
-                                        if 'download-bandwidth' in kv_params:
-                                            try:
-                                                proxy_obj['down'] = int(kv_params['download-bandwidth'])
-                                            except: pass
-                                        if 'upload-bandwidth' in kv_params:
-                                            try:
-                                                proxy_obj['up'] = int(kv_params['upload-bandwidth'])
-                                            except: pass
-                                        # 其他布尔参数
-                                        if kv_params.get('udp-relay') == 'true':
-                                            proxy_obj['udp'] = True
-                                        if kv_params.get('tfo') == 'true':
-                                            proxy_obj['fast-open'] = True
-
-
-                                    add_proxy(proxy_obj, prefix)
-                                except: pass
+                        for line in extract_proxy_lines(text_content):
+                            try:
+                                proxy_obj = surge_line_to_clash(line)
+                                if proxy_obj: add_proxy(proxy_obj, prefix)
+                            except (ValueError, KeyError): pass
 
             except Exception as e:
                 print(f"[{target}] Error fetching {src_name}: {e}")
@@ -719,55 +874,19 @@ def process_clash_config(target):
 
     if os.path.exists(manual_path):
         try:
-             with open(manual_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line in lines:
-                    line = line.strip()
-                    if not line or line.startswith(("#", ";", "//", "[")): continue
-                    if "=" in line:
-                        try:
-                            parts = line.split("=", 1)
-                            name = parts[0].strip()
-                            detail = parts[1].strip()
-                            d_parts = [x.strip() for x in detail.split(',')]
-                            if len(d_parts) < 3: continue
-                            
-                            p_type = d_parts[0].lower()
-                            p_server = d_parts[1]
-                            p_port = d_parts[2]
-                            
-                            proxy_obj = { "name": name, "type": p_type, "server": p_server, "port": p_port }
-                            
-                            kv_params = {}
-                            for item in d_parts[3:]:
-                                if "=" in item:
-                                    k, v = item.split("=", 1)
-                                    kv_params[k.strip()] = v.strip()
-                            
-                            if p_type == 'ss':
-                                proxy_obj['cipher'] = kv_params.get('encrypt-method', '')
-                                proxy_obj['password'] = kv_params.get('password', '')
-                            elif p_type in ['http', 'socks5']:
-                                proxy_obj['username'] = kv_params.get('username', '')
-                                proxy_obj['password'] = kv_params.get('password', '')
-                                if 'underlying-proxy' in kv_params:
-                                    proxy_obj['dialer-proxy'] = kv_params['underlying-proxy']
-                            
-                            # skip_rename=True 保持原名
-                            add_proxy(proxy_obj, skip_rename=True)
-                        except: pass
+            for proxy_obj in load_manual_clash_proxies(manual_path, os.stat(manual_path).st_mtime_ns):
+                # skip_rename=True 保持原名; 传入副本, 避免 add_proxy 改写缓存中的对象
+                add_proxy(dict(proxy_obj), skip_rename=True)
         except Exception as e: print(f"Manual INI Error: {e}")
     
     # 生成链式代理节点 (Entry: JP/KR/TW, Exit: EXIT)
     # 为 EXIT 创建多个版本，每个使用不同的 JP/KR/TW 节点作为 dialer-proxy
-    us_ip_proxy = None
-    for p in all_proxies:
-        if p.get('name') == 'EXIT':
-            us_ip_proxy = p
-            break
+    us_ip_proxy = name_to_proxy.get('EXIT')
     
     if us_ip_proxy:
-        import copy
+        # 链式节点只改写 name / dialer-proxy 两个标量: 字段均为标量时浅拷贝即可 (alpn 列表单独复制);
+        # 含其他嵌套结构 (如订阅节点的 ws-opts) 时仍深拷贝, 避免共享对象在 yaml.dump 中输出为锚点别名
+        needs_deepcopy = any(isinstance(v, (dict, list)) for k, v in us_ip_proxy.items() if k != 'alpn')
         chain_proxies = []
         for proxy in all_proxies:
             node_name = proxy.get('name', '')
@@ -775,51 +894,39 @@ def process_clash_config(target):
             if node_name == 'EXIT':
                 continue
             # 只为 JP/KR/TW 节点创建链式代理
-            if any(region in node_name for region in ['JP ', 'KR ', 'TW ']):
+            if CHAIN_REGION_RE.search(node_name):
                 # 创建链式代理版本: 命名为 "完整节点名 Chain"
                 chain_name = f"{node_name} Chain"
                 
-                chain_proxy = copy.deepcopy(us_ip_proxy)
+                if needs_deepcopy:
+                    chain_proxy = copy.deepcopy(us_ip_proxy)
+                else:
+                    chain_proxy = us_ip_proxy.copy()
+                    if 'alpn' in chain_proxy: chain_proxy['alpn'] = list(chain_proxy['alpn'])
                 chain_proxy['name'] = chain_name
                 chain_proxy['dialer-proxy'] = node_name
                 chain_proxies.append(chain_proxy)
-                # 同时添加到 seen_names 防止重复
-                seen_names.add(chain_proxy['name'])
+                # 同时登记名称防止重复
+                name_to_proxy[chain_name] = chain_proxy
         
         # 添加链式代理到 all_proxies
         all_proxies.extend(chain_proxies)
     
     proxy_groups = []
-    # 收集当前所有可用的节点名称
-    all_current_node_names = [p['name'] for p in all_proxies]
+    # 收集当前所有可用的节点名称 (有序, 供 filter 展开); 成员检查直接查 name_to_proxy
+    all_current_node_names = tuple(name_to_proxy)
     
     if 'Groups' in conf:
         # 处理策略组覆盖逻辑
-        raw_groups = conf['Groups']
-        final_groups = {}
-        target_suffix = f"_{target}".lower()
-        other_target = "surge" if target == "clash" else "clash"
-        other_suffix = f"_{other_target}"
-        
-        for k, v in raw_groups.items():
-            k_lower = k.lower()
-            if k_lower.endswith(target_suffix): continue
-            if k_lower.endswith(other_suffix): continue
-            final_groups[k] = v
-            
-        for k, v in raw_groups.items():
-            if k.lower().endswith(target_suffix):
-                real_name = k[:-len(target_suffix)]
-                final_groups[real_name] = v
-
+        final_groups = resolve_groups(conf['Groups'], target)
         for g_name, g_rule in final_groups.items():
             # 1. 提取并移除 {all ...} 部分
             dynamic_nodes = []
-            match = re.search(r"\{all\s*(.*?)\}", g_rule)
+            match = _ALL_RE.search(g_rule)
             if match:
                 dynamic_nodes = filter_node_list(g_rule, all_current_node_names)
                 # 将匹配到的部分替换为空，避免 split(',') 时被切碎
-                g_rule_cleaned = g_rule.replace(match.group(0), "")
+                g_rule_cleaned = g_rule[:match.start()] + g_rule[match.end():]
             else:
                 g_rule_cleaned = g_rule
             
@@ -857,6 +964,8 @@ def process_clash_config(target):
                         except: pass
                 else:
                     # 静态节点名称 (不再包含 {, }, =)
+                    if part not in name_to_proxy and part not in final_groups and part not in CLASH_BUILTIN_POLICIES:
+                        print(f"[{target}] Warning: group '{g_name}' references unknown proxy '{part}'")
                     group_proxies.append(part)
 
             if not group_proxies: group_proxies.append("DIRECT")
@@ -867,46 +976,109 @@ def process_clash_config(target):
     clash_data['proxies'] = all_proxies
     clash_data['proxy-groups'] = proxy_groups
     
-    return yaml.dump(clash_data, allow_unicode=True, sort_keys=False)
+    return yaml.dump(clash_data, Dumper=YamlDumper, allow_unicode=True, sort_keys=False)
 
 # ==========================================
 # 5. Web API 路由
 # ==========================================
 
-@app.get("/sync")
-async def sync_config(background_tasks: BackgroundTasks, target: str = Query("surge")):
-    if ".." in target or target.startswith("/"):
-        raise HTTPException(status_code=400, detail=f"Invalid target '{target}'")
+RESPONSE_CACHE = {} # {target: (mtimes, source_state, checked_at, content, body, gzip_body)}
+# target 来自查询参数, 只缓存两个已知目标, 避免任意 target 值使缓存无限增长
+CACHEABLE_TARGETS = ("surge", "clash")
 
-    content = ""
-    content_type = "text/plain"
+def config_mtimes(target):
+    """
+    相关配置/模板文件的 mtime, 任一变化即重新生成
+    这只是输出缓存键的一部分: render_config 还会比较 SOURCE_GENERATION 与各订阅的抓取状态 (source_state)
+    """
+    tpl_name = 'clash_template.yaml' if target == "clash" else 'surge_template.ini'
+    paths = [get_file_path('config', name) for name in ('config.ini', 'manual.ini', tpl_name)]
+    return tuple(os.stat(p).st_mtime_ns if os.path.exists(p) else 0 for p in paths)
+
+def render_config(target):
+    """
+    生成 target 的完整响应, 配置与订阅内容均未变化时直接复用
+    返回 (content, body, gzip_body): content 为不含头部的配置正文 (用于 Gist), body/gzip_body 为响应字节
+    """
+    mtimes = config_mtimes(target)
+    cached = RESPONSE_CACHE.get(target)
+    now = time.monotonic()
+    # 订阅缓存周期内且配置未变: 不触发任何抓取, 直接复用
+    if cached and cached[0] == mtimes and now - cached[2] < CACHE_TTL:
+        return cached[3:]
+
+    # 超过周期后重新抓取 (304 或内容相同时 SOURCE_GENERATION 不变), 订阅未变化则续期复用, 免去解析与序列化
+    conf = load_main_config(target)
+    fetched = fetch_target_sources(target, conf) if conf else []
+    source_state = (SOURCE_GENERATION, tuple(status_code for _, _, _, status_code in fetched))
+    if cached and cached[:2] == (mtimes, source_state):
+        RESPONSE_CACHE[target] = (mtimes, source_state, now) + cached[3:]
+        return cached[3:]
 
     if target == "clash":
-        content = process_clash_config(target)
-        content_type = "text/yaml"
+        content = process_clash_config(target, fetched)
     else:
-        content = process_surge_config(target)
-    
-    background_tasks.add_task(upload_to_gist, target, content)
+        content = process_surge_config(target, fetched)
 
     timestamp = get_beijing_time()
+    comment = f"# Last Updated: {timestamp} (UTC+8)\n"
+    full_text = comment + content
     
     if target == "surge":
         try:
-            conf = load_ini(target, 'config.ini')
+            conf = load_main_config(target)
             settings = conf['Settings'] if conf and 'Settings' in conf else {}
             base_url = settings.get('web_managed_url', 'http://127.0.0.1:8000/sync')
             sep = "&" if "?" in base_url else "?"
             
             header = f"#!MANAGED-CONFIG {base_url}{sep}target={target} interval=2880 strict=true\n"
-            comment = f"# Last Updated: {timestamp} (UTC+8)\n"
-            return PlainTextResponse(header + comment + content)
-        except:
-            return PlainTextResponse(content)
-    else:
-        # Clash 预览仅保留时间戳
-        comment = f"# Last Updated: {timestamp} (UTC+8)\n"
-        return Response(content=comment + content, media_type=content_type)
+            full_text = header + comment + content
+        except Exception as e:
+            print(f"[{target}] Managed header skipped: {e}")
+            full_text = content
+    # Clash 预览仅保留时间戳
+
+    body = full_text.encode('utf-8')
+    gzip_body = gzip.compress(body)
+    # 有订阅抓取失败时输出缺少节点, 不缓存, 下次请求重新抓取失败的源
+    if target in CACHEABLE_TARGETS and all(status_code == 200 for status_code in source_state[1]):
+        RESPONSE_CACHE[target] = (mtimes, source_state, now, content, body, gzip_body)
+    return content, body, gzip_body
+
+def accepts_gzip(accept_encoding):
+    """按 Accept-Encoding 的 q 值判断客户端是否接受 gzip: "gzip;q=0" 视为拒绝, 未列出 gzip 时参考 "*" """
+    q_values = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding: continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try: q = float(value)
+                except ValueError: q = 0.0
+        q_values[coding] = q
+    q = q_values.get('gzip', q_values.get('x-gzip'))
+    if q is None: q = q_values.get('*', 0.0)
+    return q > 0
+
+@app.get("/sync")
+async def sync_config(request: Request, background_tasks: BackgroundTasks, target: str = Query("surge")):
+    if ".." in target or target.startswith("/"):
+        raise HTTPException(status_code=400, detail=f"Invalid target '{target}'")
+
+    content_type = "text/yaml" if target == "clash" else "text/plain"
+    # 抓取与解析均为阻塞操作, 放到线程池执行, 避免阻塞事件循环上的其他请求
+    content, body, gzip_body = await run_in_threadpool(render_config, target)
+    
+    background_tasks.add_task(upload_to_gist, target, content)
+
+    # 客户端支持时直接返回预压缩的字节
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        return Response(content=gzip_body, media_type=content_type,
+                        headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+    return Response(content=body, media_type=content_type, headers={"Vary": "Accept-Encoding"})
 
 if __name__ == "__main__":
     import uvicorn